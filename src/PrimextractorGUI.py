@@ -1,23 +1,21 @@
 #!/usr/bin/env python3
 
-import subprocess
-import time
-import struct
-import pytesseract
-import cv2
-import io
-import numpy as np
 import os
 import configparser
-import configargparse
-import imutils
-import pyperclip
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog as fd
-from scipy import ndimage
-from PIL import Image, ImageTk, ImageFilter, ImageChops
+from lazy_import import lazy_import, preload
 from image_processing import *
+from tesseract_languages import get_languages
+from clipboard import ClipboardError, get_clipboard
+from model import DEFAULT_SETTINGS, DEFAULT_MODELS_DIR, ModelError, \
+    compile_settings, find_model, list_models, read_model, validate_settings
+from workspace import Workspace
+from history import SettingsHistory, SnapshotStore
+
+configargparse = lazy_import("configargparse")
+ImageTk = lazy_import("PIL.ImageTk")
 
 
 class Widget():
@@ -33,6 +31,12 @@ class Widget():
     def add_value_to_primextractor(self, primextractor):
         primextractor.add_value(self.valuename, self.associatedValue)
 
+    def get_value(self):
+        return self.associatedValue.get()
+
+    def set_value(self, new_value):
+        self.associatedValue.set(new_value)
+
     def set_grid(self, column, row, columnspan=1, rowspan=1):
         self.tkWidget.grid(column=column, row=row,
                            columnspan=columnspan, rowspan=rowspan)
@@ -103,16 +107,14 @@ class CanvasWidget(Widget):
         # self.width = width
         # self.height = height
         self.image = None
+        self.displayed_image = None
         self.original = False
         self.tkWidget = tk.Canvas(frame, width=width, height=height)
         self.tkWidget.pack(anchor=tk.CENTER, expand=True)
         self.add_widget_to_primextractor(primextractor)
 
     def is_image_loaded(self):
-        return (self.is_viewing_original() and
-                os.path.exists("processed/original_image.png")) or \
-            (not self.is_viewing_original() and
-             os.path.exists("processed/current_image.png"))
+        return self.displayed_image is not None
 
     def is_viewing_original(self):
         return self.original
@@ -123,13 +125,13 @@ class CanvasWidget(Widget):
     def get_dims(self):
         return (self.tkWidget.winfo_width(), self.tkWidget.winfo_height())
 
-    def update_image(self, clipboard=False):
-        if clipboard:
-            image = Image.open("processed/original_image.png")
-            self.original = True
-        else:
-            image = Image.open("processed/current_image.png")
-            self.original = False
+    def get_displayed_image(self):
+        return self.displayed_image
+
+    def update_image(self, img, original=False):
+        self.displayed_image = Image.fromarray(img)
+        self.original = original
+        image = self.displayed_image.copy()
         width, height = self.get_dims()
         image.thumbnail((width, height))
         background = Image.new('RGBA', (width, height),
@@ -152,7 +154,7 @@ class CanvasWidget(Widget):
 
 class ComboBoxWidget(Widget):
     def __init__(self, primextractor, valuename, frame,
-                 combo_choices, isInteger=False):
+                 combo_choices, isInteger=False, is_setting=True):
         self.valuename = valuename
         if isInteger:
             self.associatedValue = tk.IntVar()
@@ -165,7 +167,9 @@ class ComboBoxWidget(Widget):
         self.update_choices(combo_choices)
 
         self.add_widget_to_primextractor(primextractor)
-        self.add_value_to_primextractor(primextractor)
+        # Selectors that are not settings stay out of exported models.
+        if is_setting:
+            self.add_value_to_primextractor(primextractor)
 
     def update_choices(self, combo_choices):
         self.tkWidget["values"] = combo_choices
@@ -273,10 +277,27 @@ class ScrollableFrameWidget(Widget):
 
 
 class PrimextractorGUI():
-    def __init__(self, default_model=None):
+    def __init__(self, default_model=None, language_cache=True,
+                 preload_modules=True, clipboard_backend="auto",
+                 clipboard_dir=None, history_budget=256 * 1024 * 1024,
+                 models_dir=DEFAULT_MODELS_DIR, in_memory_workspace=True):
         self.values = {}
         self.window = {}
         self.colors = []
+        self.language_cache = language_cache
+        self.clipboard_backend = clipboard_backend
+        self.clipboard_dir = clipboard_dir
+        self.clipboard = None
+        self.original_image = None
+        self.current_image = None
+        self.model = None
+        self.model_settings = None
+        self.current_settings = None
+        self.history = SettingsHistory()
+        self.snapshots = SnapshotStore(max_bytes=history_budget)
+        self.models_dir = models_dir
+        # Private to this window, so several instances can run side by side.
+        self.workspace = Workspace(in_memory=in_memory_workspace)
         self.root = tk.Tk()
 
         self.root.title("Primextractor")
@@ -292,8 +313,19 @@ class PrimextractorGUI():
         self.root.geometry(f'{window_width}x{window_height}+' +
                            f'{position_x}+{position_y}')
         self.generate_main_frame(self.root)
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        # Valid settings even when the startup model is missing or broken.
+        self.set_settings(validate_settings({}))
         if default_model is not None:
             self.update_interface_with_model(default_model)
+        if preload_modules:
+            # Import the processing stack once the window is drawn, so the
+            # first "Process Image" does not pay for it.
+            self.root.after_idle(self.preload_processing_modules)
+
+    def preload_processing_modules(self):
+        preload(cv2, np, ndimage, Image, ImageTk, pytesseract)
 
     def get_canvas(self):
         return self.window["canvas"]
@@ -330,7 +362,12 @@ class PrimextractorGUI():
         self.window[widgetname] = widget
 
     def loop(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            if self.clipboard is not None:
+                self.clipboard.close()
+            self.workspace.cleanup()
 
     def generate_main_frame(self, root):
 
@@ -362,53 +399,37 @@ class PrimextractorGUI():
         self.generate_menu_frame(menu_frame)
         self.generate_image_frame(image_frame)
 
-    def update_key(self, config, key, win_key):
-        if "settings" in config and key in config["settings"]:
-            self.set_value(win_key, config["settings"][key])
-            return True
-        return False
-
-    def update_bool_key(self, config, key, win_key):
-        if "settings" in config:
-            if key in config["settings"] and\
-                    config["settings"][key] == "True":
-                self.set_value(win_key, 1)
-            elif key in config["settings"] and\
-                    config["settings"][key] == "False":
-                self.set_value(win_key, 0)
-
     def update_interface_with_model(self, model):
-        if os.path.exists(model):
-            config = configparser.ConfigParser()
-            config.read(model)
-            self.update_key(config, "lang", "lang")
-            self.update_key(config, "treshold_factor", "treshold_factor")
-            self.update_key(config, "psm", "psm")
-            self.update_key(config, "resizing_factor", "resizing_factor")
-            self.update_key(config, "filter_size", "clean_filter_factor")
-            self.update_bool_key(config, "invert_colors", "invert_colors")
-            self.update_bool_key(config, "clear_borders", "clear_borders")
-            self.update_key(config, "erosion_factor", "erosion_factor")
-            self.update_key(config, "dilation_factor", "dilation_factor")
-            self.update_key(config, "rotation_factor", "rotation_factor")
-            self.update_key(config, "feathering_factor", "feathering_factor")
-            self.update_key(config, "oem", "oem")
-
-            if (self.update_key(config, "color_selection",
-                                "color_selection")):
-                self.update_displayed_color(self.get_value("color_selection"))
+        model = find_model(model, self.models_dir)
+        if not os.path.exists(model):
+            return
+        try:
+            # Only the settings are needed, compiling would import numpy.
+            settings = read_model(model)
+        except ModelError as e:
+            print(f"Unable to load model {model}:")
+            print(str(e))
+            return
+        self.set_settings(settings)
+
+    def set_settings(self, settings):
+        for key, value in settings.items():
+            if isinstance(value, bool):
+                value = int(value)
+            self.set_value(key, value)
+
+        if settings["color_selection"] != "":
+            self.update_displayed_color(settings["color_selection"])
 
     def update_from_selected_model(self, event):
         self.update_interface_with_model(self.get_value("model_selection"))
         self.update_list_models()
 
     def update_list_models(self):
-        list_models = []
-        list_models += [each for each in
-                        os.listdir('.') if each.endswith('.ini')]
+        models = list_models(self.models_dir)
         selected_model = self.get_value("model_selection")
-        self.get_model_selector().update_choices(list_models)
-        if selected_model in list_models:
+        self.get_model_selector().update_choices(models)
+        if selected_model in models:
             self.set_value("model_selection", selected_model)
 
     def generate_image_frame(self, image_frame):
@@ -416,13 +437,10 @@ class PrimextractorGUI():
         self.get_canvas().bind_function(self.mouse_pressed_on_canvas)
 
     def generate_menu_frame(self, menu_frame):
-        list_models = []
-        list_models += [each for each in os.listdir('.')
-                        if each.endswith('.ini')]
-
         ttk.Label(menu_frame, text='Model selection:').grid(column=0, row=0)
         model_selector = ComboBoxWidget(self, "model_selection",
-                                        menu_frame, list_models)
+                                        menu_frame,
+                                        list_models(self.models_dir))
         model_selector.set_grid(column=1, row=0)
         model_selector.bind_function(self.update_from_selected_model)
 
@@ -458,6 +476,18 @@ class PrimextractorGUI():
                      option_frame, "Copy Processed Image",
                      command=self.copy_processed_image).\
             set_grid(column=2, row=1)
+        ButtonWidget(self, "undo",
+                     option_frame, "Undo",
+                     command=self.undo).\
+            set_grid(column=0, row=2)
+        ButtonWidget(self, "redo",
+                     option_frame, "Redo",
+                     command=self.redo).\
+            set_grid(column=1, row=2)
+        ButtonWidget(self, "compare",
+                     option_frame, "Compare",
+                     command=self.open_compare_window).\
+            set_grid(column=2, row=2)
 
         result_frame = ttk.Frame(menu_frame)
         result_frame.grid(column=0, row=3, columnspan=3)
@@ -520,6 +550,8 @@ class PrimextractorGUI():
                           "Clear Borders").set_grid(column=1, row=4)
         CheckButtonWidget(self, "color_diff_enabled", setting_frame,
                           "Enable Color Difference").set_grid(column=2, row=4)
+        CheckButtonWidget(self, "adaptive_resize", setting_frame,
+                          "Adaptive Resize").set_grid(column=3, row=4)
 
         ttk.Label(setting_frame, text='PSM:').grid(column=0, row=5)
         ComboBoxWidget(self, "psm",
@@ -533,7 +565,8 @@ class PrimextractorGUI():
 
         ttk.Label(setting_frame, text='Lang:').grid(column=4, row=5)
         ComboBoxWidget(self, "lang",
-                       setting_frame, pytesseract.get_languages(config='')).\
+                       setting_frame,
+                       get_languages(use_cache=self.language_cache)).\
             set_grid(column=5, row=5)
 
         ttk.Label(setting_frame, text='Feathering:').grid(column=0, row=6)
@@ -551,33 +584,45 @@ class PrimextractorGUI():
                     resolution=0.1).\
             set_grid(column=1, row=8, columnspan=2)
 
+        ttk.Label(setting_frame, text='Glyph Height:').grid(column=0, row=9)
+        ScaleWidget(self, "target_glyph_height", setting_frame, (8, 100),
+                    resolution=1).\
+            set_grid(column=1, row=9, columnspan=2)
+
     def export_current_settings_as_model(self):
-        file = fd.asksaveasfile(mode='w', defaultextension=".ini")
+        file = fd.asksaveasfile(mode='w', defaultextension=".ini",
+                                initialdir=self.models_dir)
         if file is None:
             return
         if os.path.splitext(file.name)[1] == ".ini":
             config = configparser.ConfigParser()
             config["settings"] = {}
-            for key in self.values:
-                if key not in [""]:
-                    config["settings"][key] = str(self.get_value(key))
+            for key, value in self.get_settings().items():
+                config["settings"][key] = str(value)
             config.write(file)
             self.update_list_models()
         file.close()
 
+    def get_clipboard(self):
+        # One backend for the whole session, so the display connection is
+        # reused across reads and writes.
+        if self.clipboard is None:
+            self.clipboard = get_clipboard(self.clipboard_backend,
+                                           self.clipboard_dir)
+        return self.clipboard
+
     def load_image_clipboard(self):
         try:
-            stream = subprocess.\
-                check_output(["xclip", "-selection", "clipboard",
-                              "-t", "image/png", "-o"])
-            nparr = np.frombuffer(stream, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            if not os.path.exists("processed"):
-                os.makedirs("processed")
-            cv2.imwrite("processed/original_image.png", img)
-        except Exception:
+            self.original_image = self.get_clipboard().read_image()
+        except ClipboardError as e:
             print("Unable to open clipboard!")
-        self.get_canvas().update_image(clipboard=True)
+            print(str(e))
+            return
+        # Snapshots only make sense for the image they were computed from.
+        self.history.clear()
+        self.snapshots.clear()
+        self.current_settings = None
+        self.get_canvas().update_image(self.original_image, original=True)
 
     def get_value(self, valuename):
         return self.values[valuename].get()
@@ -585,6 +630,17 @@ class PrimextractorGUI():
     def set_value(self, valuename, new_value):
         self.values[valuename].set(new_value)
 
+    def get_settings(self):
+        return {key: self.get_value(key) for key in DEFAULT_SETTINGS}
+
+    def get_model(self):
+        # Only recompiled when a setting actually changed.
+        settings = self.get_settings()
+        if self.model is None or self.model_settings != settings:
+            self.model = compile_settings(settings)
+            self.model_settings = settings
+        return self.model
+
     def clipboard_and_processing(self):
         self.load_image_clipboard()
         self.process_image()
@@ -594,73 +650,129 @@ class PrimextractorGUI():
         self.process_image()
         self.apply_tesseract()
 
-    def process_image(self):
-        if not self.get_canvas().is_image_loaded():
+    def get_snapshot(self, model):
+        # Returns the processed image and its snapshot, which is None when
+        # the image could not be stored; the image is shown either way.
+        snapshot = self.snapshots.get(model.settings)
+        if snapshot is not None:
+            return snapshot.get_image(), snapshot
+        image = process_pipeline(self.original_image, model,
+                                 workspace=self.workspace)
+        return image, self.snapshots.put(model.settings, image)
+
+    def process_image(self, record=True):
+        if self.original_image is None:
             print("Load from clipboard image first")
             return
 
-        image = Image.open("processed/original_image.png")
+        try:
+            model = self.get_model()
+        except ModelError as e:
+            print("Invalid settings:")
+            print(str(e))
+            return
+        self.current_image, snapshot = self.get_snapshot(model)
+        self.current_settings = model.settings
+        if record:
+            self.history.push(model.settings)
 
-        image = rotate_image(image, self.get_value("rotation_factor"))
-        image = resize_image(image, self.get_value("resizing_factor"))
+        self.get_canvas().update_image(self.current_image)
+        return snapshot
 
-        image = convert_to_gray(image, self.get_value("color_diff_enabled"),
-                                self.get_value("color_selection"))
-        image = set_inverted(image, self.get_value("invert_colors"))
-        image = set_treshold(image, self.get_value("treshold_factor"),
-                             self.get_value("clean_filter_factor"))
+    def show_history_entry(self, settings):
+        if settings is None:
+            return
+        self.set_settings(settings)
+        snapshot = self.process_image(record=False)
+        if snapshot is not None:
+            self.get_extraction_results().set_text(snapshot.text or "")
 
-        # image = first_filter(image, self.get_value("isonoise"))
-        image = clear_image(image, self.get_value("invert_colors"),
-                            self.get_value("clear_borders"))
-        image = apply_filter(image, self.get_value("feathering_factor"),
-                             self.get_value("erosion_factor"),
-                             self.get_value("dilation_factor"))
-        cv2.imwrite("processed/current_image.png", image)
+    def undo(self):
+        self.show_history_entry(self.history.undo())
 
-        self.get_canvas().update_image()
+    def redo(self):
+        self.show_history_entry(self.history.redo())
+
+    def open_compare_window(self):
+        if self.original_image is None or not self.history.entries:
+            print("Process an image first")
+            return
+        compare_window = tk.Toplevel(self.root)
+        compare_window.title("Primextractor - Compare")
+        labels = self.history.get_labels()
+        for column, side in enumerate(("a", "b")):
+            side_frame = ttk.Frame(compare_window)
+            side_frame.grid(column=column, row=0)
+            selector_frame = ttk.Frame(side_frame)
+            selector_frame.pack()
+            canvas_frame = ttk.Frame(side_frame)
+            canvas_frame.pack()
+            text_frame = ttk.Frame(side_frame)
+            text_frame.pack()
+
+            selector = ComboBoxWidget(self, f"compare_{side}",
+                                      selector_frame, labels,
+                                      is_setting=False)
+            selector.set_grid(column=0, row=0)
+            CanvasWidget(self, f"compare_canvas_{side}", canvas_frame,
+                         400, 400)
+            DynamicTextWidget(self, f"compare_text_{side}", text_frame, "").\
+                set_grid(column=0, row=0)
+            selector.bind_function(
+                lambda event, side=side: self.update_compare_side(side))
+
+        # Start by comparing the current entry with the one before it.
+        current = self.history.index
+        self.window["compare_a"].set_value(labels[max(current - 1, 0)])
+        self.window["compare_b"].set_value(labels[current])
+        compare_window.update_idletasks()
+        self.update_compare_side("a")
+        self.update_compare_side("b")
+
+    def update_compare_side(self, side):
+        label = self.window[f"compare_{side}"].get_value()
+        settings = self.history.entries[int(label.split(":")[0])]
+        image, snapshot = self.get_snapshot(compile_settings(settings))
+        self.window[f"compare_canvas_{side}"].update_image(image)
+        text = snapshot.text if snapshot is not None else None
+        self.window[f"compare_text_{side}"].set_text(text or "")
 
     def apply_tesseract(self):
-        if not self.get_canvas().is_image_loaded():
+        if self.current_image is None:
             print("Error: No Image found")
             return
 
-        img = Image.open("processed/current_image.png")
         try:
-            oem = self.get_value("oem")
-            psm = self.get_value("psm")
-            lang = self.get_value("lang")
-            text = pytesseract.image_to_string(
-                    img, lang=lang, config=f"--oem {oem} --psm {psm}")
-
-            text = text.replace(' ', '').replace('、', ',').\
-                replace('。', '.').replace('…', '...')
-            new_text = ''
-            skipNextLine = True
-
-            for line in text.split('\n'):
-                if not skipNextLine:
-                    new_text += '\n'
-                new_text += line
-                if len(line) > 0 and line[-1] not in '.?!]』一':
-                    skipNextLine = True
-                elif len(line) > 0:
-                    skipNextLine = False
-
-            if lang[-4:] == "vert":
-                lang = lang[:-5]
+            model = self.get_model()
+            # Text is only cached when the displayed image was produced
+            # with the current settings.
+            cacheable = model.settings == self.current_settings
+            snapshot = self.snapshots.get(model.settings) \
+                if cacheable else None
+            if snapshot is not None and snapshot.text is not None:
+                new_text = snapshot.text
+            else:
+                new_text = extract_text(self.current_image, model.lang,
+                                        model.tesseract_config)
+                if cacheable:
+                    self.snapshots.set_text(model.settings, new_text)
 
             print(new_text)
             self.get_extraction_results().set_text(new_text)
-            pyperclip.copy(new_text)
+            self.get_clipboard().write_text(new_text)
         except Exception as e:
             print("Error during tesseract execution:")
             print(str(e))
 
     def copy_processed_image(self):
-        current_image = open("processed/current_image.png")
-        subprocess.run(["xclip", "-selection", "clipboard", "-t", "image/png"],
-                       stdin=current_image)
+        if self.current_image is None:
+            print("Error: No Image found")
+            return
+        try:
+            copy_final_result(self.current_image, self.get_clipboard())
+        except ClipboardError as e:
+            print("Unable to write to clipboard!")
+            print(str(e))
 
     def mouse_pressed_on_canvas(self, event):
         x, y = self.get_canvas().get_mouse_coords(event)
@@ -668,14 +780,11 @@ class PrimextractorGUI():
         self.update_color_selector(color)
 
     def pick_color(self, x, y):
-        if not self.get_canvas().is_image_loaded():
+        canvas = self.get_canvas()
+        if not canvas.is_image_loaded():
             return None
-        if self.get_canvas().is_viewing_original():
-            image = Image.open("processed/original_image.png")
-        else:
-            image = Image.open("processed/current_image.png")
+        image = canvas.get_displayed_image()
 
-        canvas = self.get_canvas()
         canvas_w, canvas_h = canvas.get_dims()
         y = canvas_h - y
         img_w, img_h = image.size
@@ -736,10 +845,36 @@ def main():
     parser.add_argument('-m', '--model-template',
                         type=str, default="default.ini",
                         help='Model templates')
+    parser.add_argument('--no-language-cache', action='store_true',
+                        help='Query tesseract for the language list '
+                        'instead of using the on-disk cache')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='Do not import the processing modules '
+                        'in the background after startup')
+    parser.add_argument('--clipboard', type=str, default="auto",
+                        choices=["auto", "x11", "wayland", "file"],
+                        help='Clipboard backend')
+    parser.add_argument('--clipboard-dir', type=str, default=None,
+                        help='Directory used by the file clipboard backend')
+    parser.add_argument('--history-budget', type=int, default=256,
+                        help='Memory used to keep previous results, in MB')
+    parser.add_argument('--models-dir', type=str, default=DEFAULT_MODELS_DIR,
+                        help='Directory the model selection is listed from')
+    parser.add_argument('--workspace', type=str, default="memory",
+                        choices=["memory", "tmpfs"],
+                        help='Keep intermediate images in memory buffers '
+                        'or in a private scratch directory')
     args = parser.parse_args()
     model = args.model_template
 
-    PrimextractorGUI(default_model=model).loop()
+    PrimextractorGUI(default_model=model,
+                     language_cache=not args.no_language_cache,
+                     preload_modules=not args.no_preload,
+                     clipboard_backend=args.clipboard,
+                     clipboard_dir=args.clipboard_dir,
+                     history_budget=args.history_budget * 1024 * 1024,
+                     models_dir=args.models_dir,
+                     in_memory_workspace=args.workspace == "memory").loop()
 
 
 if __name__ == "__main__":
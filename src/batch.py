@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import os
+import multiprocessing.util
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from lazy_import import lazy_import
+from image_processing import extract_text, process_pipeline
+from model import find_model, load_model
+from workspace import Workspace
+from image_store import ImageHandle, ImageStore
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageSequence = lazy_import("PIL.ImageSequence")
+fitz = lazy_import("fitz")
+configargparse = lazy_import("configargparse")
+
+PDF_EXTENSIONS = (".pdf",)
+
+WORKER_MODEL = None
+WORKER_WORKSPACE = None
+WORKER_STORE = None
+
+
+def keep_page(img, store):
+    # Pages go to the image store when there is one, workers then only
+    # receive a handle.
+    if store is None:
+        return img.copy()
+    return store.put(img)
+
+
+def iter_pdf_pages(path, dpi, store=None):
+    with fitz.open(path) as document:
+        for page_number, page in enumerate(document, start=1):
+            pixmap = page.get_pixmap(dpi=dpi, alpha=False)
+            img = np.frombuffer(pixmap.samples, np.uint8).\
+                reshape(pixmap.height, pixmap.width, pixmap.n)
+            # The pixmap owns the buffer, so keep a copy of the page only.
+            yield page_number, keep_page(img, store)
+
+
+def iter_image_pages(path, store=None):
+    # Multi-page TIFFs are decoded one frame at a time.
+    with Image.open(path) as image:
+        for page_number, frame in \
+                enumerate(ImageSequence.Iterator(image), start=1):
+            img = np.asarray(frame.convert("RGB"))
+            yield page_number, keep_page(img, store)
+
+
+def iter_pages(path, dpi=300, store=None):
+    if path.lower().endswith(PDF_EXTENSIONS):
+        yield from iter_pdf_pages(path, dpi, store)
+    else:
+        yield from iter_image_pages(path, store)
+
+
+def init_worker(model, in_memory_workspace, use_store, store_dir):
+    global WORKER_MODEL, WORKER_WORKSPACE, WORKER_STORE
+    # Sent once per worker rather than with every page.
+    WORKER_MODEL = model
+    WORKER_WORKSPACE = Workspace(in_memory=in_memory_workspace)
+    # Pool workers skip atexit handlers, only these finalizers run.
+    multiprocessing.util.Finalize(WORKER_WORKSPACE, WORKER_WORKSPACE.cleanup,
+                                  exitpriority=10)
+    if use_store:
+        WORKER_STORE = ImageStore(store_dir)
+        multiprocessing.util.Finalize(WORKER_STORE, WORKER_STORE.cleanup,
+                                      exitpriority=10)
+    # Pages already run in parallel, a multithreaded tesseract per worker
+    # would only oversubscribe the cores.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def ocr_page(page):
+    if isinstance(page, ImageHandle):
+        img = page.open()
+    else:
+        img = page
+    img = process_pipeline(img, WORKER_MODEL, workspace=WORKER_WORKSPACE,
+                           store=WORKER_STORE)
+    return extract_text(img, WORKER_MODEL.lang,
+                        WORKER_MODEL.tesseract_config)
+
+
+def write_result(output, output_format, path, page_number, text,
+                 error=None):
+    if output_format == "jsonl":
+        record = {"file": path, "page": page_number, "text": text}
+        if error is not None:
+            record["error"] = error
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+    else:
+        # Errors that are not about one page have no page number.
+        header = path if page_number is None \
+            else f"{path} - page {page_number}"
+        if error is not None:
+            output.write(f"=== {header} (error) ===\n{error}\n")
+        else:
+            output.write(f"=== {header} ===\n{text}\n")
+    output.flush()
+
+
+def run_batch(paths, model, output, output_format="text", dpi=300,
+              workers=None, max_in_flight=None, in_memory_workspace=True,
+              use_store=True, store_dir=None):
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    in_flight = collections.deque()
+    store = ImageStore(store_dir) if use_store else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(model, in_memory_workspace,
+                                           use_store, store_dir)) \
+                as executor:
+            for path in paths:
+                try:
+                    submit_pages(executor, path, dpi, store, in_flight,
+                                 max_in_flight, output, output_format)
+                except Exception as e:
+                    # An unreadable file is reported after the pages of it
+                    # that could be read, and the batch goes on.
+                    error = f"{type(e).__name__}: {e}"
+                    print(f"{path} failed: {error}", file=sys.stderr)
+                    while in_flight:
+                        write_result(output, output_format,
+                                     *wait_oldest(in_flight, store))
+                    write_result(output, output_format, path, None, "",
+                                 error)
+            while in_flight:
+                write_result(output, output_format,
+                             *wait_oldest(in_flight, store))
+    finally:
+        if store is not None:
+            store.cleanup()
+
+
+def submit_pages(executor, path, dpi, store, in_flight, max_in_flight,
+                 output, output_format):
+    for page_number, page in iter_pages(path, dpi, store):
+        # Results are written in page order; waiting on the oldest page
+        # also caps how many pages are alive at once.
+        if len(in_flight) >= max_in_flight:
+            write_result(output, output_format,
+                         *wait_oldest(in_flight, store))
+        in_flight.append((path, page_number, page,
+                          executor.submit(ocr_page, page)))
+        del page
+
+
+def wait_oldest(in_flight, store):
+    # A failed page is reported in the output and the batch goes on.
+    path, page_number, page, future = in_flight.popleft()
+    text = ""
+    error = None
+    try:
+        text = future.result()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"Page {page_number} of {path} failed: {error}",
+              file=sys.stderr)
+    finally:
+        if store is not None:
+            store.release(page)
+    return path, page_number, text, error
+
+
+def main():
+    parser = configargparse.\
+        ArgParser(description='Extract text from multi-page PDFs and images')
+    parser.add_argument('inputs', nargs='+',
+                        help='PDF, TIFF or image files')
+    parser.add_argument('-m', '--model-template',
+                        type=str, default="default.ini",
+                        help='Model templates')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Output file, defaults to stdout')
+    parser.add_argument('-f', '--format', type=str, default="text",
+                        choices=["text", "jsonl"], help='Output format')
+    parser.add_argument('--dpi', type=int, default=300,
+                        help='Resolution used to rasterize PDF pages')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum number of pages decoded at once, '
+                        'defaults to twice the number of workers')
+    parser.add_argument('--workspace', type=str, default="memory",
+                        choices=["memory", "tmpfs"],
+                        help='Keep intermediate images in memory buffers '
+                        'or in a private scratch directory per worker')
+    parser.add_argument('--no-image-store', action='store_true',
+                        help='Send pages to workers by pickling them '
+                        'instead of through memory-mapped files')
+    parser.add_argument('--image-store-dir', type=str, default=None,
+                        help='Directory of the memory-mapped files, '
+                        'defaults to tmpfs, falling back to the temporary '
+                        'directory when tmpfs is full; use a disk directory '
+                        'to spill large pages out of RAM')
+    args = parser.parse_args()
+
+    model = load_model(find_model(args.model_template))
+    if args.output is None:
+        output = sys.stdout
+    else:
+        output = open(args.output, "w", encoding="utf-8")
+    try:
+        run_batch(args.inputs, model, output, args.format, args.dpi,
+                  args.workers, args.max_in_flight,
+                  args.workspace == "memory", not args.no_image_store,
+                  args.image_store_dir)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
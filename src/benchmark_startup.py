@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import statistics
+import subprocess
+import sys
+import configargparse
+from tesseract_languages import clear_cache
+
+# Time from interpreter start until the window has been drawn once.
+STARTUP_SNIPPET = """
+import time
+start = time.perf_counter()
+import PrimextractorGUI
+gui = PrimextractorGUI.PrimextractorGUI(default_model={model!r},
+                                        language_cache={language_cache},
+                                        preload_modules=False)
+gui.root.update()
+print(time.perf_counter() - start)
+gui.root.destroy()
+"""
+
+
+def measure_startup(model, language_cache):
+    snippet = STARTUP_SNIPPET.format(model=model,
+                                     language_cache=language_cache)
+    output = subprocess.check_output([sys.executable, "-c", snippet])
+    return float(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def run_benchmark(model, runs, language_cache, cold):
+    timings = []
+    for _ in range(runs):
+        if cold:
+            clear_cache()
+        timings.append(measure_startup(model, language_cache))
+    return timings
+
+
+def print_timings(label, timings):
+    print(f"{label}: min {min(timings):.3f}s, "
+          f"median {statistics.median(timings):.3f}s, "
+          f"max {max(timings):.3f}s ({len(timings)} runs)")
+
+
+def main():
+    parser = configargparse.\
+        ArgParser(description='Measure GUI startup time')
+    parser.add_argument('-m', '--model-template',
+                        type=str, default="default.ini",
+                        help='Model template loaded at startup')
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='Number of launches per configuration')
+    args = parser.parse_args()
+
+    print_timings("no language cache",
+                  run_benchmark(args.model_template, args.runs,
+                                language_cache=False, cold=False))
+    print_timings("cold language cache",
+                  run_benchmark(args.model_template, args.runs,
+                                language_cache=True, cold=True))
+    print_timings("warm language cache",
+                  run_benchmark(args.model_template, args.runs,
+                                language_cache=True, cold=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import select
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from lazy_import import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+X = lazy_import("Xlib.X")
+Xatom = lazy_import("Xlib.Xatom")
+xdisplay = lazy_import("Xlib.display")
+xevent = lazy_import("Xlib.protocol.event")
+xerror = lazy_import("Xlib.error")
+
+PNG_TARGET = "image/png"
+TEXT_TARGETS = ["UTF8_STRING", "text/plain;charset=utf-8",
+                "STRING", "TEXT"]
+
+
+class ClipboardError(Exception):
+    pass
+
+
+def get_x_errors():
+    # Connection failures are not Xlib.error.Error subclasses.
+    return (xerror.Error, xerror.DisplayError, xerror.ConnectionClosedError)
+
+
+class Clipboard():
+    def read(self, target):
+        raise NotImplementedError
+
+    def write(self, contents):
+        raise NotImplementedError
+
+    def read_image(self):
+        stream = self.read(PNG_TARGET)
+        if len(stream) == 0:
+            raise ClipboardError("Clipboard does not contain an image")
+        try:
+            img = cv2.imdecode(np.frombuffer(stream, np.uint8),
+                               cv2.IMREAD_COLOR)
+        except cv2.error as e:
+            raise ClipboardError(str(e))
+        if img is None:
+            raise ClipboardError("Clipboard does not contain an image")
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def write_image(self, img):
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        success, stream = cv2.imencode(".png", img)
+        if not success:
+            raise ClipboardError("Unable to encode image")
+        self.write({PNG_TARGET: stream.tobytes()})
+
+    def write_text(self, text):
+        data = text.encode("utf-8")
+        self.write({target: data for target in TEXT_TARGETS})
+
+    def close(self):
+        pass
+
+
+class FileClipboard(Clipboard):
+    # Stand-in backed by a directory, one file per target, used for tests
+    # and headless runs.
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, target):
+        return os.path.join(self.directory,
+                            target.replace("/", "_").replace(";", "_"))
+
+    def read(self, target):
+        path = self.get_path(target)
+        if not os.path.exists(path):
+            raise ClipboardError(f"No {target} data in {self.directory}")
+        with open(path, "rb") as file:
+            return file.read()
+
+    def write(self, contents):
+        for target, data in contents.items():
+            with open(self.get_path(target), "wb") as file:
+                file.write(data)
+
+
+class WaylandClipboard(Clipboard):
+    # Used only without an X server: there is no Wayland binding among our
+    # dependencies, so this goes through wl-clipboard.
+    def read(self, target):
+        try:
+            return subprocess.check_output(["wl-paste", "--no-newline",
+                                            "--type", target])
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise ClipboardError(str(e))
+
+    def write(self, contents):
+        target = PNG_TARGET if PNG_TARGET in contents else TEXT_TARGETS[1]
+        try:
+            subprocess.run(["wl-copy", "--type", target],
+                           input=contents[target], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise ClipboardError(str(e))
+
+
+class X11Clipboard(Clipboard):
+    # Talks to the X server directly over a single connection that is kept
+    # for the lifetime of the object. Owning a selection means answering
+    # SelectionRequest events, which a daemon thread does in the background.
+    def __init__(self, selection="CLIPBOARD", timeout=2.0):
+        self.display = xdisplay.Display()
+        self.window = self.display.screen().root.create_window(
+            0, 0, 1, 1, 0, X.CopyFromParent,
+            event_mask=X.PropertyChangeMask)
+        self.selection = self.get_atom(selection)
+        self.property = self.get_atom("PRIMEXTRACTOR_SELECTION")
+        self.targets_atom = self.get_atom("TARGETS")
+        self.incr_atom = self.get_atom("INCR")
+        self.timeout = timeout
+        max_request = self.display.display.info.max_request_length * 4
+        self.chunk_size = min(256 * 1024, max_request - 1024)
+        self.contents = {}
+        self.written = {}
+        self.transfers = {}
+        self.lock = threading.RLock()
+        self.closed = False
+        self.thread = None
+
+    def get_atom(self, name):
+        return self.display.intern_atom(name)
+
+    def owns_selection(self):
+        owner = self.display.get_selection_owner(self.selection)
+        return owner != X.NONE and owner.id == self.window.id
+
+    def read(self, target):
+        try:
+            with self.lock:
+                target_atom = self.get_atom(target)
+                if self.contents and self.owns_selection():
+                    if target_atom not in self.contents:
+                        raise ClipboardError(f"No {target} data in "
+                                             "clipboard")
+                    return self.contents[target_atom]
+                return self.convert_selection(target_atom)
+        except get_x_errors() as e:
+            raise ClipboardError(f"X11 error: {e}")
+
+    def convert_selection(self, target_atom):
+        self.window.convert_selection(self.selection, target_atom,
+                                      self.property, X.CurrentTime)
+        self.display.flush()
+        event = self.wait_for_event(
+            lambda e: e.type == X.SelectionNotify and
+            e.requestor.id == self.window.id)
+        if event.property == X.NONE:
+            raise ClipboardError("Clipboard owner refused the conversion")
+
+        reply = self.window.get_full_property(self.property,
+                                              X.AnyPropertyType)
+        self.window.delete_property(self.property)
+        self.display.flush()
+        if reply is None:
+            raise ClipboardError("Clipboard owner sent no data")
+        if reply.property_type != self.incr_atom:
+            return bytes(reply.value)
+
+        chunks = []
+        while True:
+            self.wait_for_event(
+                lambda e: e.type == X.PropertyNotify and
+                e.window.id == self.window.id and
+                e.atom == self.property and
+                e.state == X.PropertyNewValue)
+            reply = self.window.get_full_property(self.property,
+                                                  X.AnyPropertyType)
+            self.window.delete_property(self.property)
+            self.display.flush()
+            if reply is None or len(reply.value) == 0:
+                return b"".join(chunks)
+            chunks.append(bytes(reply.value))
+
+    def wait_for_event(self, matches):
+        # Events that are not for us still have to be dispatched, otherwise
+        # we would stop answering requests for our own selection.
+        deadline = time.monotonic() + self.timeout
+        while True:
+            while self.display.pending_events():
+                event = self.display.next_event()
+                if matches(event):
+                    return event
+                self.dispatch(event)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ClipboardError("Timed out waiting for clipboard owner")
+            select.select([self.display], [], [], remaining)
+
+    def write(self, contents):
+        try:
+            with self.lock:
+                self.written = dict(contents)
+                self.contents = {self.get_atom(target): data
+                                 for target, data in contents.items()}
+                self.window.set_selection_owner(self.selection,
+                                                X.CurrentTime)
+                self.display.flush()
+                if not self.owns_selection():
+                    self.contents = {}
+                    raise ClipboardError("Unable to take clipboard "
+                                         "ownership")
+        except get_x_errors() as e:
+            raise ClipboardError(f"X11 error: {e}")
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.serve, daemon=True)
+            self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            with self.lock:
+                while self.display.pending_events():
+                    self.dispatch(self.display.next_event())
+            select.select([self.display], [], [], 0.1)
+
+    def dispatch(self, event):
+        if event.type == X.SelectionRequest:
+            self.answer_request(event)
+        elif event.type == X.SelectionClear:
+            self.contents = {}
+        elif event.type == X.PropertyNotify and \
+                event.state == X.PropertyDelete:
+            self.continue_transfer(event)
+
+    def answer_request(self, event):
+        requestor = event.requestor
+        prop = event.property if event.property != X.NONE else event.target
+        if event.target == self.targets_atom:
+            targets = [self.targets_atom] + list(self.contents)
+            requestor.change_property(prop, Xatom.ATOM, 32, targets)
+        elif event.target in self.contents:
+            data = self.contents[event.target]
+            if len(data) > self.chunk_size:
+                requestor.change_attributes(event_mask=X.PropertyChangeMask)
+                requestor.change_property(prop, self.incr_atom, 32,
+                                          [len(data)])
+                self.transfers[(requestor.id, prop)] = \
+                    (requestor, event.target, data, 0)
+            else:
+                requestor.change_property(prop, event.target, 8, data)
+        else:
+            prop = X.NONE
+
+        notify = xevent.SelectionNotify(time=event.time, requestor=requestor,
+                                        selection=event.selection,
+                                        target=event.target, property=prop)
+        requestor.send_event(notify)
+        self.display.flush()
+
+    def continue_transfer(self, event):
+        key = (event.window.id, event.atom)
+        if key not in self.transfers:
+            return
+        requestor, target, data, offset = self.transfers[key]
+        chunk = data[offset:offset + self.chunk_size]
+        requestor.change_property(event.atom, target, 8, chunk)
+        if len(chunk) == 0:
+            del self.transfers[key]
+        else:
+            self.transfers[key] = (requestor, target, data,
+                                   offset + len(chunk))
+        self.display.flush()
+
+    def hand_off(self):
+        # The selection dies with its owner, so before exiting a detached
+        # helper takes it over, as xclip does, and serves it until another
+        # client copies something.
+        with self.lock:
+            if not self.contents or not self.owns_selection():
+                return
+            contents = self.written
+        try:
+            helper = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--serve"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                start_new_session=True)
+            helper.stdin.write(pickle.dumps(contents))
+            helper.stdin.close()
+            ready = select.select([helper.stdout], [], [], self.timeout)[0]
+            if not ready or helper.stdout.readline() != b"ready\n":
+                raise ClipboardError("Clipboard helper did not start")
+        except OSError as e:
+            raise ClipboardError(str(e))
+
+    def wait_until_cleared(self):
+        while self.contents and not self.closed:
+            time.sleep(0.2)
+
+    def close(self, hand_off=True):
+        if hand_off:
+            try:
+                self.hand_off()
+            except (ClipboardError, *get_x_errors()) as e:
+                print("Clipboard content will be lost on exit:")
+                print(str(e))
+        self.closed = True
+        if self.thread is not None:
+            self.thread.join()
+        self.display.close()
+
+
+def get_clipboard(backend="auto", directory=None):
+    if backend == "auto":
+        if directory is not None:
+            backend = "file"
+        elif os.environ.get("DISPLAY"):
+            # Also covers Wayland sessions, Xwayland bridges the clipboard.
+            backend = "x11"
+        elif os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-paste"):
+            backend = "wayland"
+        else:
+            raise ClipboardError("No clipboard available")
+
+    if backend == "file":
+        return FileClipboard(directory or "clipboard")
+    if backend == "x11":
+        try:
+            return X11Clipboard()
+        except ImportError as e:
+            raise ClipboardError(str(e))
+        except get_x_errors() as e:
+            raise ClipboardError(f"Unable to connect to the X server: {e}")
+    if backend == "wayland":
+        return WaylandClipboard()
+    raise ClipboardError(f"Unknown clipboard backend: {backend}")
+
+
+def serve_selection():
+    # Entry point of the helper started by X11Clipboard.hand_off.
+    contents = pickle.load(sys.stdin.buffer)
+    clipboard = X11Clipboard()
+    clipboard.write(contents)
+    sys.stdout.write("ready\n")
+    sys.stdout.close()
+    clipboard.wait_until_cleared()
+    clipboard.close(hand_off=False)
+
+
+if __name__ == "__main__" and sys.argv[1:] == ["--serve"]:
+    serve_selection()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import csv
+import itertools
+import os
+import sys
+import time
+from lazy_import import lazy_import
+from image_processing import process_pipeline, recognize_text, timed
+from model import DEFAULT_SETTINGS, find_model, load_model
+
+cv2 = lazy_import("cv2")
+matplotlib = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+configargparse = lazy_import("configargparse")
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+# tesstrain names ground truth <image>.gt.txt, plain <image>.txt also works.
+REFERENCE_SUFFIXES = (".gt.txt", ".txt")
+STAGES = ("rotate", "measure", "resize", "gray", "threshold", "clear",
+          "filter", "tesseract")
+
+
+def levenshtein(reference, hypothesis):
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref_item in enumerate(reference, start=1):
+        current = [i]
+        for j, hyp_item in enumerate(hypothesis, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ref_item != hyp_item)))
+        previous = current
+    return previous[-1]
+
+
+def error_rate(reference, hypothesis):
+    if len(reference) == 0:
+        return 0.0 if len(hypothesis) == 0 else 1.0
+    return levenshtein(reference, hypothesis) / len(reference)
+
+
+def character_error_rate(reference, hypothesis):
+    # Whitespace is not counted: tesseract puts spaces between CJK
+    # characters that the references do not have.
+    return error_rate("".join(reference.split()),
+                      "".join(hypothesis.split()))
+
+
+def word_error_rate(reference, hypothesis):
+    return error_rate(reference.split(), hypothesis.split())
+
+
+def find_reference(image_path):
+    stem = os.path.splitext(image_path)[0]
+    for suffix in REFERENCE_SUFFIXES:
+        if os.path.exists(stem + suffix):
+            return stem + suffix
+    return None
+
+
+def load_dataset(directory):
+    samples = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        reference = find_reference(path)
+        if reference is None:
+            print(f"Skipping {path}: no reference text")
+            continue
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"Skipping {path}: unreadable image")
+            continue
+        with open(reference, encoding="utf-8") as file:
+            text = file.read()
+        # The pipeline expects RGB, as it gets from the clipboard.
+        samples.append((name, cv2.cvtColor(img, cv2.COLOR_BGR2RGB), text))
+    return samples
+
+
+def parse_sweep(sweeps):
+    parameters = []
+    for sweep in sweeps:
+        key, _, values = sweep.partition("=")
+        if key not in DEFAULT_SETTINGS or values == "":
+            raise ValueError(f"Invalid sweep {sweep}, expected "
+                             "setting=value1,value2,...")
+        parameters.append([(key, value) for value in values.split(",")])
+    return [dict(combination)
+            for combination in itertools.product(*parameters)]
+
+
+def evaluate_model(model, samples):
+    timings = {}
+    cer = 0.0
+    wer = 0.0
+    pixels = 0
+    elapsed = 0.0
+    for _, img, reference in samples:
+        pixels += img.shape[0] * img.shape[1]
+        # Scoring is left out of the time, it grows with the output length.
+        start = time.perf_counter()
+        processed = process_pipeline(img, model, timings)
+        # Scored before clean_text, which drops spaces and joins lines.
+        hypothesis = timed(timings, "tesseract", recognize_text, processed,
+                           model.lang, model.tesseract_config)
+        elapsed += time.perf_counter() - start
+        cer += character_error_rate(reference, hypothesis)
+        wer += word_error_rate(reference, hypothesis)
+    count = len(samples)
+    return {
+        "cer": cer / count,
+        "wer": wer / count,
+        "seconds_per_image": elapsed / count,
+        "images_per_second": count / elapsed,
+        "megapixels_per_second": pixels / elapsed / 1e6,
+        "stages": {stage: timings.get(stage, 0) / count
+                   for stage in STAGES},
+    }
+
+
+def pareto_front(results):
+    # A configuration is on the front when no other one is both at least as
+    # fast and at least as accurate, and strictly better in one of the two.
+    front = []
+    for result in results:
+        dominated = any(
+            other["seconds_per_image"] <= result["seconds_per_image"] and
+            other["cer"] <= result["cer"] and
+            (other["seconds_per_image"] < result["seconds_per_image"] or
+             other["cer"] < result["cer"])
+            for other in results)
+        if not dominated:
+            front.append(result)
+    return sorted(front, key=lambda result: result["seconds_per_image"])
+
+
+def describe(overrides):
+    if not overrides:
+        return "model settings"
+    return ", ".join(f"{key}={value}" for key, value in overrides.items())
+
+
+def print_results(results, front):
+    print(f"{'model':<20} {'configuration':<40} {'CER':>7} {'WER':>7} "
+          f"{'s/img':>8} {'img/s':>7} {'MP/s':>7}")
+    for result in results:
+        marker = "*" if result in front else " "
+        print(f"{result['model']:<20} {result['configuration']:<40} "
+              f"{result['cer']:>7.3f} {result['wer']:>7.3f} "
+              f"{result['seconds_per_image']:>8.3f} "
+              f"{result['images_per_second']:>7.2f} "
+              f"{result['megapixels_per_second']:>7.2f} {marker}")
+    print("\nPer-stage latency (s/img):")
+    print(f"{'model':<20} {'configuration':<40} " +
+          " ".join(f"{stage:>9}" for stage in STAGES))
+    for result in results:
+        print(f"{result['model']:<20} {result['configuration']:<40} " +
+              " ".join(f"{result['stages'][stage]:>9.4f}"
+                       for stage in STAGES))
+    print("\n* on the accuracy/time Pareto front")
+
+
+def write_csv(results, path):
+    fields = ["model", "dataset", "configuration", "cer", "wer",
+              "seconds_per_image", "images_per_second",
+              "megapixels_per_second"]
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(fields + [f"{stage}_seconds" for stage in STAGES])
+        for result in results:
+            writer.writerow([result[field] for field in fields] +
+                            [result["stages"][stage] for stage in STAGES])
+
+
+def plot_results(results, front, path):
+    matplotlib.use("Agg")
+    figure, axes = plt.subplots()
+    axes.scatter([result["seconds_per_image"] for result in results],
+                 [result["cer"] for result in results], label="configuration")
+    axes.plot([result["seconds_per_image"] for result in front],
+              [result["cer"] for result in front], "r-o",
+              label="Pareto front")
+    for result in front:
+        axes.annotate(f"{result['model']}: {result['configuration']}",
+                      (result["seconds_per_image"], result["cer"]),
+                      fontsize=7)
+    axes.set_xlabel("seconds per image")
+    axes.set_ylabel("CER")
+    axes.legend()
+    figure.savefig(path)
+
+
+def main():
+    parser = configargparse.\
+        ArgParser(description='Measure OCR accuracy and speed of models '
+                  'on a labeled dataset')
+    parser.add_argument('-m', '--model-template', action='append',
+                        required=True, help='Model to evaluate, repeatable')
+    parser.add_argument('-d', '--dataset', action='append', required=True,
+                        help='Directory of images with <name>.gt.txt or '
+                        '<name>.txt references, one per model or one '
+                        'shared by all models')
+    parser.add_argument('-s', '--sweep', action='append', default=[],
+                        help='Settings to sweep, e.g. '
+                        'resizing_factor=1,1.5,2; repeat for a grid')
+    parser.add_argument('--csv', type=str, default=None,
+                        help='Write the results to a CSV file')
+    parser.add_argument('--plot', type=str, default=None,
+                        help='Save the accuracy/time plot to this file')
+    args = parser.parse_args()
+
+    models = args.model_template
+    datasets = args.dataset
+    if len(datasets) == 1:
+        datasets = datasets * len(models)
+    elif len(datasets) != len(models):
+        parser.error("Give one dataset, or one dataset per model")
+
+    configurations = parse_sweep(args.sweep) if args.sweep else [{}]
+    loaded_datasets = {}
+    results = []
+    for model_path, dataset in zip(models, datasets):
+        if dataset not in loaded_datasets:
+            loaded_datasets[dataset] = load_dataset(dataset)
+        samples = loaded_datasets[dataset]
+        if not samples:
+            print(f"No labeled images in {dataset}")
+            sys.exit(1)
+        model = load_model(find_model(model_path))
+        for overrides in configurations:
+            result = evaluate_model(model.with_settings(**overrides),
+                                    samples)
+            result.update({"model": os.path.basename(model_path),
+                           "dataset": dataset,
+                           "configuration": describe(overrides)})
+            results.append(result)
+
+    front = pareto_front(results)
+    print_results(results, front)
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    if args.plot is not None:
+        plot_results(results, front, args.plot)
+
+
+if __name__ == "__main__":
+    main()
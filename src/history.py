@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import collections
+from lazy_import import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+
+
+def get_settings_key(settings):
+    return tuple(sorted(settings.items()))
+
+
+def describe_settings(settings, reference):
+    if reference is None:
+        return "initial"
+    changes = [f"{key}={value}" for key, value in settings.items()
+               if reference.get(key) != value]
+    return ", ".join(changes) if changes else "no change"
+
+
+class Snapshot():
+    def __init__(self, settings, data, text=None):
+        self.settings = settings
+        self.data = data
+        self.text = text
+
+    def get_image(self):
+        return cv2.imdecode(np.frombuffer(self.data, np.uint8),
+                            cv2.IMREAD_UNCHANGED)
+
+    def get_size(self):
+        size = len(self.data)
+        if self.text is not None:
+            size += len(self.text.encode("utf-8"))
+        return size
+
+
+class SnapshotStore():
+    # Processed images for one source image, keyed by settings, stored as
+    # PNG (binarized pages compress very well) and evicted least recently
+    # used first once the byte budget is exceeded.
+    def __init__(self, max_bytes=256 * 1024 * 1024, compression=1):
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.snapshots = collections.OrderedDict()
+        self.size = 0
+
+    def __contains__(self, settings):
+        return get_settings_key(settings) in self.snapshots
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def clear(self):
+        self.snapshots.clear()
+        self.size = 0
+
+    def get(self, settings):
+        key = get_settings_key(settings)
+        if key not in self.snapshots:
+            return None
+        self.snapshots.move_to_end(key)
+        return self.snapshots[key]
+
+    def put(self, settings, img, text=None):
+        success, data = cv2.imencode(
+            ".png", img, [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+        if not success:
+            return None
+        self.remove(settings)
+        snapshot = Snapshot(dict(settings), data.tobytes(), text)
+        self.snapshots[get_settings_key(settings)] = snapshot
+        self.size += snapshot.get_size()
+        self.evict()
+        return snapshot
+
+    def set_text(self, settings, text):
+        snapshot = self.get(settings)
+        if snapshot is None:
+            return
+        self.size -= snapshot.get_size()
+        snapshot.text = text
+        self.size += snapshot.get_size()
+        self.evict()
+
+    def remove(self, settings):
+        snapshot = self.snapshots.pop(get_settings_key(settings), None)
+        if snapshot is not None:
+            self.size -= snapshot.get_size()
+
+    def evict(self):
+        # The most recent snapshot is kept even if it alone is over budget.
+        while self.size > self.max_bytes and len(self.snapshots) > 1:
+            _, snapshot = self.snapshots.popitem(last=False)
+            self.size -= snapshot.get_size()
+
+
+class SettingsHistory():
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self.entries = []
+        self.index = -1
+
+    def clear(self):
+        self.entries = []
+        self.index = -1
+
+    def get_current(self):
+        if self.index < 0:
+            return None
+        return self.entries[self.index]
+
+    def push(self, settings):
+        if settings == self.get_current():
+            return
+        # A new entry after an undo drops the entries that could be redone.
+        del self.entries[self.index + 1:]
+        self.entries.append(dict(settings))
+        if len(self.entries) > self.max_entries:
+            del self.entries[0]
+        self.index = len(self.entries) - 1
+
+    def can_undo(self):
+        return self.index > 0
+
+    def can_redo(self):
+        return self.index < len(self.entries) - 1
+
+    def undo(self):
+        if not self.can_undo():
+            return None
+        self.index -= 1
+        return self.entries[self.index]
+
+    def redo(self):
+        if not self.can_redo():
+            return None
+        self.index += 1
+        return self.entries[self.index]
+
+    def get_labels(self):
+        labels = []
+        previous = None
+        for number, settings in enumerate(self.entries):
+            labels.append(f"{number}: {describe_settings(settings, previous)}")
+            previous = settings
+        return labels
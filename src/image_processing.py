@@ -1,28 +1,61 @@
 #!/usr/bin/env python3
 
+import functools
 import subprocess
 import time
-import struct
-import cv2
-import io
-import numpy as np
-import os
-import configparser
-import configargparse
-import imutils
-import pyperclip
-from scipy import ndimage
-from PIL import Image, ImageFilter, ImageChops
-
-
-def rotate_image(img, rotation):
+from lazy_import import lazy_import
+
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+ndimage = lazy_import("scipy.ndimage")
+special = lazy_import("scipy.special")
+Image = lazy_import("PIL.Image")
+pytesseract = lazy_import("pytesseract")
+
+# Glyphs are measured on a copy whose longest side is at most this long.
+GLYPH_MEASURE_SIZE = 1000
+MIN_GLYPH_COMPONENTS = 3
+# Resize factors are rounded to the resolution of the GUI slider.
+ADAPTIVE_RESIZE_STEP = 0.1
+ADAPTIVE_RESIZE_RANGE = (0.2, 5)
+
+
+def get_rotated_shape(shape, rotation):
+    # Same bounds computation as ndimage.rotate with reshape=True.
+    rotation *= -1
+    c, s = special.cosdg(rotation), special.sindg(rotation)
+    iy, ix = shape[:2]
+    out_bounds = np.array([[c, s], [-s, c]]) @ [[0, 0, iy, iy],
+                                                [0, ix, 0, ix]]
+    out_plane_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    return tuple(out_plane_shape) + tuple(shape[2:])
+
+
+def get_resized_shape(shape, size):
+    if size > 1:
+        return (int(shape[0] * size), int(shape[1] * size)) + \
+            tuple(shape[2:])
+    if size < 1 and size > 0:
+        return (round(shape[0] * size), round(shape[1] * size)) + \
+            tuple(shape[2:])
+    return tuple(shape)
+
+
+def rotate_image(img, rotation, output=None):
     rotation *= -1
-    img = np.array(img)
+    img = np.asarray(img)
+    if rotation == 0:
+        return img
+    if output is not None:
+        ndimage.rotate(img, angle=rotation, output=output)
+        return output
     img = ndimage.rotate(img, angle=rotation)
     return img
 
 
-def resize_image(img, size):
+def resize_image(img, size, output=None):
+    # output is only used when shrinking: PIL's Lanczos filter, which the
+    # models are tuned for, cannot write into an existing buffer.
     if size > 1:
         image = Image.fromarray(img)
         width, height = image.size
@@ -30,40 +63,71 @@ def resize_image(img, size):
         image = image.resize(new_size, Image.Resampling.LANCZOS)
         img = np.array(image)
     elif size < 1 and size > 0:
-        img = cv2.resize(img, None, fx=size, fy=size,
+        img = cv2.resize(img, None, dst=output, fx=size, fy=size,
                          interpolation=cv2.INTER_AREA)
     return img
 
 
-def set_treshold(img, treshold, filter_size):
-    if filter_size > 1:
-        if filter_size % 2 == 0:
-            filter_size += 1
+def set_treshold(img, treshold, block_size):
+    if block_size > 1:
         img = cv2.adaptiveThreshold(img, 255,
                                     cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                     cv2.THRESH_BINARY,
-                                    int(filter_size), treshold)
+                                    block_size, treshold)
     else:
         img = cv2.threshold(img, treshold, 255, cv2.THRESH_BINARY)[1]
     return img
 
 
-def convert_to_gray(img, enable_colordiff, color):
-    if enable_colordiff and color != "":
-        color = color[1:]
-        img = Image.fromarray(img)
-        color = struct.unpack('BBB', bytes.fromhex(color))
-        background_color = Image.new('RGB', img.size, color)
-        img = ImageChops.difference(img, background_color)
-        img = np.asarray(img)
+def estimate_glyph_height(img):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    scale = min(1, GLYPH_MEASURE_SIZE / max(gray.shape[:2]))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale,
+                          interpolation=cv2.INTER_AREA)
+    binary = cv2.threshold(gray, 0, 255,
+                           cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    # Text is whichever side of the threshold covers less of the page.
+    if cv2.countNonZero(binary) > binary.size // 2:
+        binary = cv2.bitwise_not(binary)
+    # Joins the strokes of a glyph, so radicals and accents are not counted
+    # as glyphs of their own. Shrinking already does that, and closing the
+    # shrunk page would also join the lines of tightly set text.
+    if scale == 1:
+        binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE,
+                                  np.ones((3, 3), np.uint8))
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary,
+                                                          connectivity=8)
+    heights = stats[1:count, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:count, cv2.CC_STAT_WIDTH]
+    # Leave out specks and frames. Glyphs merged into a run of any width
+    # still have the height of a glyph, so they are kept.
+    glyphs = (heights >= 2) & (heights < 0.9 * binary.shape[0]) & \
+        (widths < 0.9 * binary.shape[1])
+    if np.count_nonzero(glyphs) < MIN_GLYPH_COMPONENTS:
+        return None
+    return float(np.median(heights[glyphs])) / scale
+
+
+def choose_resizing_factor(img, target_height, default_factor):
+    glyph_height = estimate_glyph_height(img)
+    if glyph_height is None:
+        return default_factor
+    low, high = ADAPTIVE_RESIZE_RANGE
+    factor = min(max(target_height / glyph_height, low), high)
+    return round(round(factor / ADAPTIVE_RESIZE_STEP) *
+                 ADAPTIVE_RESIZE_STEP, 1)
+
+
+def convert_to_gray(img, color_lut=None):
+    if color_lut is not None:
+        img = cv2.LUT(img, color_lut)
     img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     return img
 
 
-def copy_final_result():
-    current_image = open("processed/current_image.png")
-    subprocess.run(["xclip", "-selection", "clipboard", "-t", "image/png"],
-                   stdin=current_image)
+def copy_final_result(img, clipboard):
+    clipboard.write_image(img)
 
 
 def set_inverted(img, inverted):
@@ -72,29 +136,41 @@ def set_inverted(img, inverted):
     return img
 
 
-def apply_filter(img, feathering, erosion, dilation):
+@functools.lru_cache(maxsize=None)
+def get_quantum_range():
+    qrange = subprocess.check_output(
+            "convert xc: -format \"%[fx:quantumrange]\" info:".split())
+    return qrange.decode("utf-8")[1:-1]
+
+
+def feather_image(img, feathering, workspace=None):
+    options = ["-blur", f"{feathering}x{get_quantum_range()}",
+               "-level", "50%,100%", "-define", "png:color-type=6"]
+    if workspace is None or workspace.in_memory:
+        stream = cv2.imencode(".png", img)[1].tobytes()
+        stream = subprocess.run(["convert", "png:-"] + options + ["png:-"],
+                                input=stream, stdout=subprocess.PIPE,
+                                check=True).stdout
+        img = cv2.imdecode(np.frombuffer(stream, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        text_to_clean = workspace.get_path("text_to_clean2.png")
+        text_cleaned = workspace.get_path("text_cleaned2.png")
+        cv2.imwrite(text_to_clean, img)
+        subprocess.run(["convert", text_to_clean] + options +
+                       [text_cleaned], check=True)
+        img = cv2.imread(text_cleaned)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def apply_filter(img, feathering, erosion_kernel=None, dilation_kernel=None,
+                 workspace=None):
     if int(feathering) > 0:
-        cv2.imwrite("processed/text_to_clean2.png", img)
-        qrange = subprocess.check_output(
-                "convert xc: -format \"%[fx:quantumrange]\" info:".split())
-        qrange = qrange.decode("utf-8")[1:-1]
-
-        subprocess.run(["convert", "processed/text_to_clean2.png", "-blur",
-                        f"{feathering}x{qrange}", "-level", "50%,100%",
-                        "-define", "png:color-type=6",
-                        "processed/text_cleaned2.png"])
-
-        img = cv2.imread("processed/text_cleaned2.png")
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    erosion = int(erosion)
-    dilation = int(dilation)
-    if erosion > 0:
-        kernel = np.ones((erosion, erosion), np.uint8)
-        img = cv2.erode(img, kernel)
-    if dilation > 0:
-        kernel = np.ones((dilation, dilation), np.uint8)
-        img = cv2.dilate(img, kernel)
+        img = feather_image(img, feathering, workspace)
+
+    if erosion_kernel is not None:
+        img = cv2.erode(img, erosion_kernel)
+    if dilation_kernel is not None:
+        img = cv2.dilate(img, dilation_kernel)
     return img
 
 
@@ -120,3 +196,91 @@ def clear_image(img, inverted, clear):
                     cv2.floodFill(im_floodfill, None, point, (255, 255, 255))
         img = im_floodfill
     return img
+
+
+def timed(timings, stage, function, *args):
+    # Adds the time spent in function to timings[stage] when timings is set.
+    if timings is None:
+        return function(*args)
+    start = time.perf_counter()
+    result = function(*args)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+    return result
+
+
+def binarize(img, model):
+    if model.binarize_lut is not None:
+        return cv2.LUT(img, model.binarize_lut)
+    img = set_inverted(img, model.inverted)
+    return set_treshold(img, model.treshold, model.block_size)
+
+
+def allocate_stage_output(store, handles, shape, dtype):
+    if store is None:
+        return None
+    handle, output = store.allocate(shape, dtype)
+    handles.append(handle)
+    return output
+
+
+def process_pipeline(img, model, timings=None, workspace=None, store=None):
+    # With an image store, the full-size colour intermediates of rotation
+    # and downscaling live in its memory-mapped files rather than on the
+    # heap.
+    handles = []
+    output = None
+    if model.rotation != 0:
+        output = allocate_stage_output(
+            store, handles, get_rotated_shape(img.shape, model.rotation),
+            img.dtype)
+    img = timed(timings, "rotate", rotate_image, img, model.rotation, output)
+
+    resizing_factor = model.resizing_factor
+    if model.adaptive_resize:
+        resizing_factor = timed(timings, "measure", choose_resizing_factor,
+                                img, model.target_glyph_height,
+                                model.resizing_factor)
+    output = None
+    resized_shape = get_resized_shape(img.shape, resizing_factor)
+    if resizing_factor < 1 and resized_shape != img.shape:
+        output = allocate_stage_output(store, handles, resized_shape,
+                                       img.dtype)
+    img = timed(timings, "resize", resize_image, img, resizing_factor,
+                output)
+
+    img = timed(timings, "gray", convert_to_gray, img, model.color_lut)
+    for handle in handles:
+        store.release(handle)
+    img = timed(timings, "threshold", binarize, img, model)
+
+    img = timed(timings, "clear", clear_image, img, model.inverted,
+                model.clear_borders)
+    img = timed(timings, "filter", apply_filter, img, model.feathering,
+                model.erosion_kernel, model.dilation_kernel, workspace)
+    return img
+
+
+def clean_text(text):
+    text = text.replace(' ', '').replace('、', ',').\
+        replace('。', '.').replace('…', '...')
+    new_text = ''
+    skipNextLine = True
+
+    for line in text.split('\n'):
+        if not skipNextLine:
+            new_text += '\n'
+        new_text += line
+        if len(line) > 0 and line[-1] not in '.?!]』一':
+            skipNextLine = True
+        elif len(line) > 0:
+            skipNextLine = False
+    return new_text
+
+
+def recognize_text(img, lang, config):
+    return pytesseract.image_to_string(Image.fromarray(img), lang=lang,
+                                       config=config)
+
+
+def extract_text(img, lang, config):
+    return clean_text(recognize_text(img, lang, config))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import errno
+import itertools
+import os
+import tempfile
+from lazy_import import lazy_import
+from workspace import Workspace, get_free_space
+
+np = lazy_import("numpy")
+
+# Left free for the other processes allocating from the same filesystem.
+FREE_SPACE_MARGIN = 16 * 1024 * 1024
+
+
+class ImageHandle():
+    # Picklable reference to an image kept in a memory-mapped file. Sending
+    # one to another process costs a few bytes instead of the whole array.
+    def __init__(self, path, shape, dtype):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def open(self, mode="r"):
+        return np.memmap(self.path, dtype=self.dtype, mode=mode,
+                         shape=self.shape)
+
+
+class ImageStore():
+    # Images backed by files in a private directory. On tmpfs (the default)
+    # this is shared memory; a directory on disk lets large batches spill
+    # out of RAM. Released files stay readable through existing mappings.
+    def __init__(self, directory=None):
+        self.workspace = Workspace(in_memory=False, base_dir=directory,
+                                   prefix="primextractor-store-")
+        self.spill_workspace = None
+        self.counter = itertools.count()
+
+    def get_workspace(self, size):
+        # Mapped files only get their pages when written, so one that does
+        # not fit crashes the process with SIGBUS instead of raising. Images
+        # that do not fit (e.g. in Docker's 64 MB /dev/shm) go to disk.
+        size += FREE_SPACE_MARGIN
+        if get_free_space(self.workspace.directory) >= size:
+            return self.workspace
+        if self.spill_workspace is None:
+            self.spill_workspace = Workspace(
+                in_memory=False, base_dir=tempfile.gettempdir(),
+                prefix="primextractor-store-")
+        if get_free_space(self.spill_workspace.directory) >= size:
+            return self.spill_workspace
+        raise OSError(errno.ENOSPC, "No space left for the image store")
+
+    def allocate(self, shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        path = self.get_workspace(size).\
+            get_path(f"{next(self.counter)}.raw")
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=tuple(shape))
+        return ImageHandle(path, shape, np.dtype(dtype).str), array
+
+    def put(self, img):
+        handle, array = self.allocate(img.shape, img.dtype)
+        array[...] = img
+        array.flush()
+        return handle
+
+    def release(self, handle):
+        if os.path.exists(handle.path):
+            os.remove(handle.path)
+
+    def cleanup(self):
+        self.workspace.cleanup()
+        if self.spill_workspace is not None:
+            self.spill_workspace.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
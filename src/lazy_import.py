@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    # Stand-in for a module that is only imported on first attribute access,
+    # so heavy dependencies (cv2, scipy, PIL, ...) stay out of startup.
+    def __init__(self, name):
+        super().__init__(name)
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __dir__(self):
+        return dir(self.load())
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def preload(*modules):
+    for module in modules:
+        if isinstance(module, LazyModule):
+            module.load()
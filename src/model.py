@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import configparser
+import os
+from lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+# Settings used when a model file does not define a key.
+DEFAULT_SETTINGS = {
+    "lang": "eng",
+    "psm": 3,
+    "oem": 3,
+    "rotation_factor": 0,
+    "resizing_factor": 1.0,
+    "adaptive_resize": False,
+    "target_glyph_height": 30,
+    "treshold_factor": 0,
+    "clean_filter_factor": 0,
+    "invert_colors": False,
+    "clear_borders": False,
+    "color_diff_enabled": False,
+    "color_selection": "",
+    "feathering_factor": 0.0,
+    "erosion_factor": 0.0,
+    "dilation_factor": 0.0,
+}
+
+# Older models use the .ini name on the left for the setting on the right.
+KEY_ALIASES = {
+    "filter_size": "clean_filter_factor",
+}
+
+# Inclusive bounds, matching the ranges offered by the GUI.
+SETTING_RANGES = {
+    "psm": (0, 13),
+    "oem": (0, 3),
+    "resizing_factor": (0, 5),
+    "target_glyph_height": (8, 100),
+    "treshold_factor": (0, 255),
+    "clean_filter_factor": (0, 100),
+    "feathering_factor": (0, 10),
+    "erosion_factor": (0, 10),
+    "dilation_factor": (0, 10),
+}
+
+# The bundled models live next to the sources.
+DEFAULT_MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODEL_CACHE = {}
+
+
+class ModelError(ValueError):
+    pass
+
+
+class CompiledModel():
+    # Everything the pipeline derives from the settings, computed once per
+    # model instead of once per image.
+    def __init__(self, settings, name=None):
+        self.settings = validate_settings(settings)
+        self.name = name
+        self.lang = self.settings["lang"]
+        self.rotation = self.settings["rotation_factor"]
+        self.resizing_factor = self.settings["resizing_factor"]
+        # Picks the resizing factor per image from the measured glyph
+        # height; resizing_factor is only used when nothing can be measured.
+        self.adaptive_resize = self.settings["adaptive_resize"]
+        self.target_glyph_height = self.settings["target_glyph_height"]
+        self.inverted = self.settings["invert_colors"]
+        self.clear_borders = self.settings["clear_borders"]
+        self.feathering = self.settings["feathering_factor"]
+        self.tesseract_config = f"--oem {self.settings['oem']} " + \
+            f"--psm {self.settings['psm']}"
+
+        self.color = None
+        self.color_lut = None
+        color = self.settings["color_selection"]
+        if self.settings["color_diff_enabled"] and color != "":
+            self.color = parse_color(color)
+            # |value - color| for each channel, same as ImageChops.difference
+            values = np.arange(256, dtype=np.int16).reshape(256, 1)
+            self.color_lut = np.abs(values - np.array(self.color)).\
+                astype(np.uint8).reshape(1, 256, 3)
+
+        self.treshold = self.settings["treshold_factor"]
+        self.block_size = int(self.settings["clean_filter_factor"])
+        self.binarize_lut = None
+        if self.block_size > 1:
+            if self.block_size % 2 == 0:
+                self.block_size += 1
+        else:
+            self.block_size = 0
+            # Inversion followed by a global threshold is a single lookup.
+            values = np.arange(256, dtype=np.uint8)
+            if self.inverted:
+                values = 255 - values
+            self.binarize_lut = np.where(values > self.treshold, 255, 0).\
+                astype(np.uint8)
+
+        self.erosion_kernel = get_kernel(self.settings["erosion_factor"])
+        self.dilation_kernel = get_kernel(self.settings["dilation_factor"])
+
+    def with_settings(self, **overrides):
+        settings = dict(self.settings)
+        settings.update(overrides)
+        return CompiledModel(settings, self.name)
+
+
+def get_kernel(factor):
+    size = int(factor)
+    if size <= 0:
+        return None
+    return np.ones((size, size), np.uint8)
+
+
+def parse_color(color):
+    if len(color) != 7 or color[0] != "#":
+        raise ModelError(f"Invalid color {color}, expected #rrggbb")
+    try:
+        return tuple(bytes.fromhex(color[1:]))
+    except ValueError:
+        raise ModelError(f"Invalid color {color}, expected #rrggbb")
+
+
+def parse_bool(value):
+    return value.strip() in ("True", "true", "1")
+
+
+def parse_setting(key, value):
+    default = DEFAULT_SETTINGS[key]
+    try:
+        if isinstance(default, bool):
+            return parse_bool(value)
+        if isinstance(default, int):
+            return int(float(value))
+        if isinstance(default, float):
+            return float(value)
+    except ValueError:
+        raise ModelError(f"Invalid value {value!r} for {key}")
+    return value
+
+
+def validate_settings(settings):
+    validated = dict(DEFAULT_SETTINGS)
+    for key, value in settings.items():
+        if key not in DEFAULT_SETTINGS:
+            continue
+        if isinstance(value, str):
+            value = parse_setting(key, value)
+        validated[key] = value
+    for key, (low, high) in SETTING_RANGES.items():
+        if not low <= validated[key] <= high:
+            raise ModelError(f"{key}={validated[key]} is outside "
+                             f"[{low}, {high}]")
+    if validated["lang"] == "":
+        raise ModelError("lang must not be empty")
+    return validated
+
+
+def read_settings(model, seen=()):
+    # A model can extend another one with "inherits = other.ini" in its
+    # [model] section; its own [settings] override the inherited ones.
+    model = os.path.abspath(model)
+    if not os.path.exists(model):
+        raise ModelError(f"Model {model} not found")
+    if model in seen:
+        raise ModelError(f"Model {model} inherits from itself")
+    config = configparser.ConfigParser()
+    config.read(model)
+
+    settings = {}
+    if "model" in config and "inherits" in config["model"]:
+        parent = os.path.join(os.path.dirname(model),
+                              config["model"]["inherits"])
+        settings.update(read_settings(parent, seen + (model,)))
+    if "settings" in config:
+        for key, value in config["settings"].items():
+            key = KEY_ALIASES.get(key, key)
+            if key in DEFAULT_SETTINGS:
+                settings[key] = value
+    return settings
+
+
+def read_model(model):
+    return validate_settings(read_settings(model))
+
+
+def compile_settings(settings, name=None):
+    return CompiledModel(settings, name)
+
+
+def load_model(model):
+    # The .ini files are cheap to re-read, compiling is what gets cached, so
+    # edits to a model or to any model it inherits from are picked up.
+    settings = read_settings(model)
+    key = (os.path.basename(model),) + tuple(sorted(settings.items()))
+    if key not in MODEL_CACHE:
+        MODEL_CACHE[key] = CompiledModel(settings, os.path.basename(model))
+    return MODEL_CACHE[key]
+
+
+def list_models(models_dir=DEFAULT_MODELS_DIR):
+    return sorted(each for each in os.listdir(models_dir)
+                  if each.endswith('.ini'))
+
+
+def find_model(model, models_dir=DEFAULT_MODELS_DIR):
+    # Bare names are looked up in models_dir, even when the working
+    # directory has a file of the same name; paths are used as given.
+    if os.path.isabs(model) or os.path.dirname(model) != "":
+        return model
+    return os.path.join(models_dir, model)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+from lazy_import import lazy_import
+
+pytesseract = lazy_import("pytesseract")
+
+TESSDATA_CANDIDATES = [
+    "/usr/share/tesseract-ocr/5/tessdata",
+    "/usr/share/tesseract-ocr/4.00/tessdata",
+    "/usr/share/tessdata",
+    "/usr/local/share/tessdata",
+    "/opt/homebrew/share/tessdata",
+]
+
+
+def get_cache_file():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "primextractor", "languages.json")
+
+
+def find_tessdata_dir():
+    candidates = []
+    prefix = os.environ.get("TESSDATA_PREFIX")
+    if prefix:
+        candidates += [prefix, os.path.join(prefix, "tessdata")]
+    candidates += TESSDATA_CANDIDATES
+    for candidate in candidates:
+        if glob.glob(os.path.join(candidate, "*.traineddata")):
+            return os.path.abspath(candidate)
+    return None
+
+
+def get_tessdata_signature(tessdata_dir):
+    # Adding or removing a traineddata file updates the directory mtime,
+    # which is enough to invalidate the cached list.
+    stat = os.stat(tessdata_dir)
+    return {"tessdata_dir": tessdata_dir, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(cache_file, signature, languages):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file, "w") as file:
+            json.dump({"signature": signature, "languages": languages}, file)
+    except OSError:
+        print("Unable to write language cache!")
+
+
+def clear_cache():
+    cache_file = get_cache_file()
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+
+def get_languages(use_cache=True):
+    tessdata_dir = find_tessdata_dir()
+    if not use_cache or tessdata_dir is None:
+        return pytesseract.get_languages(config='')
+
+    cache_file = get_cache_file()
+    signature = get_tessdata_signature(tessdata_dir)
+    cache = read_cache(cache_file)
+    if cache is not None and cache.get("signature") == signature:
+        return cache["languages"]
+
+    languages = pytesseract.get_languages(config='')
+    write_cache(cache_file, signature, languages)
+    return languages
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import pytest
+from evaluate import character_error_rate, error_rate, levenshtein, \
+    pareto_front, word_error_rate
+
+
+def test_levenshtein():
+    assert levenshtein("kitten", "sitting") == 3
+    assert levenshtein("", "abc") == 3
+    assert levenshtein("abc", "abc") == 0
+    assert levenshtein(["a", "b"], ["b"]) == 1
+
+
+def test_error_rate_empty_reference():
+    assert error_rate("", "") == 0.0
+    assert error_rate("", "a") == 1.0
+
+
+def test_character_error_rate():
+    assert character_error_rate("abcd", "abed") == pytest.approx(0.25)
+    assert character_error_rate("a b\nc", "a  b c\n") == 0.0
+    # Spaced out CJK output is not penalised.
+    assert character_error_rate("日本語", "日 本 語") == 0.0
+
+
+def test_word_error_rate():
+    assert word_error_rate("the quick fox", "the quick fox") == 0.0
+    assert word_error_rate("the quick fox", "the quack fox") == \
+        pytest.approx(1 / 3)
+    assert word_error_rate("the quick fox", "thequickfox") == 1.0
+
+
+def test_pareto_front():
+    fast = {"seconds_per_image": 1.0, "cer": 0.2}
+    accurate = {"seconds_per_image": 2.0, "cer": 0.1}
+    dominated = {"seconds_per_image": 3.0, "cer": 0.3}
+    assert pareto_front([dominated, accurate, fast]) == [fast, accurate]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import pytest
+from image_processing import choose_resizing_factor, estimate_glyph_height
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+
+
+def draw_page(height, width, glyph_height, gap, leading=None):
+    # Lines of solid black glyphs with no word spaces, the worst case for
+    # glyphs merging into one component per line.
+    img = np.full((height, width, 3), 255, np.uint8)
+    widths = np.random.default_rng(0).integers(glyph_height // 2,
+                                               glyph_height, size=width)
+    margin = width // 10
+    y = margin
+    while y + glyph_height < height - margin:
+        x = margin
+        for glyph_width in widths:
+            if x + glyph_width > width - margin:
+                break
+            cv2.rectangle(img, (x, y),
+                          (x + glyph_width - 1, y + glyph_height - 1),
+                          (0, 0, 0), -1)
+            x += glyph_width + gap
+        y += glyph_height + (leading or glyph_height)
+    return img
+
+
+@pytest.mark.parametrize("height, width, glyph_height, gap, leading", [
+    (600, 800, 12, 2, None),
+    (3508, 2480, 30, 4, None),
+    (3508, 2480, 30, 4, 8),
+    (7016, 4960, 60, 8, None),
+])
+def test_estimate_glyph_height(height, width, glyph_height, gap, leading):
+    img = draw_page(height, width, glyph_height, gap, leading)
+    assert estimate_glyph_height(img) == \
+        pytest.approx(glyph_height, rel=0.15)
+
+
+def test_estimate_glyph_height_blank_page():
+    img = np.full((500, 400, 3), 255, np.uint8)
+    assert estimate_glyph_height(img) is None
+
+
+def test_choose_resizing_factor():
+    img = draw_page(7016, 4960, 60, 8)
+    assert choose_resizing_factor(img, 30, 2) == pytest.approx(0.5)
+    blank = np.full((500, 400, 3), 255, np.uint8)
+    assert choose_resizing_factor(blank, 30, 2) == 2
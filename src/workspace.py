@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import weakref
+
+# tmpfs on most Linux systems, scratch files there never hit the disk.
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def get_scratch_dir():
+    if os.path.isdir(SHARED_MEMORY_DIR) and \
+            os.access(SHARED_MEMORY_DIR, os.W_OK):
+        return SHARED_MEMORY_DIR
+    return None
+
+
+def get_free_space(directory):
+    stats = os.statvfs(directory)
+    return stats.f_bavail * stats.f_frsize
+
+
+class Workspace():
+    # Scratch space private to one job. In memory mode no directory is
+    # created and steps that need files exchange buffers through pipes
+    # instead; otherwise a unique directory is created on tmpfs when
+    # available and removed on cleanup, or when the workspace is collected.
+    def __init__(self, in_memory=True, base_dir=None,
+                 prefix="primextractor-"):
+        self.in_memory = in_memory
+        self.directory = None
+        self.finalizer = None
+        if not in_memory:
+            self.directory = tempfile.mkdtemp(
+                prefix=prefix, dir=base_dir or get_scratch_dir())
+            self.finalizer = weakref.finalize(self, shutil.rmtree,
+                                              self.directory,
+                                              ignore_errors=True)
+
+    def get_path(self, name):
+        if self.directory is None:
+            raise ValueError("In-memory workspaces have no files")
+        return os.path.join(self.directory, name)
+
+    def cleanup(self):
+        if self.finalizer is not None:
+            self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()